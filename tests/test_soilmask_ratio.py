@@ -4,7 +4,9 @@
 import os
 import re
 import json
+import shutil
 import subprocess
+import pytest
 import numpy as np
 import PIL.Image
 from osgeo import gdal
@@ -198,3 +200,69 @@ def test_ratio_plain_tiff():
     img = gdal.Open(os.path.join(working_space, orthomosaic_mask_name)).ReadAsArray()
     assert img is not None
     assert isinstance(img, np.ndarray)
+
+
+def test_gen_plant_bitmask():
+    """Tests the bit-packed plant mask against the full binary mask"""
+    # pylint: disable=import-outside-toplevel
+    import transformer as tr
+
+    source_image = os.path.join(TESTING_FILE_PATH, 'orthomosaic.tif')
+    assert os.path.exists(source_image)
+    img = np.array(PIL.Image.open(source_image))
+
+    bitmask = tr.gen_plant_bitmask(img)
+    bin_mask, _ = tr.__internal__.gen_plant_mask(img, tr.GREEN_RED_RATIO)
+
+    # The packed mask is one bit per pixel along each row
+    assert bitmask.shape == (img.shape[0], (img.shape[1] + 7) // 8)
+
+    # Unpacking must round-trip back to the binary mask
+    unpacked = np.unpackbits(bitmask, axis=1, count=img.shape[1])
+    assert np.array_equal(unpacked * np.uint8(255), bin_mask)
+
+    # Invalid ratios are rejected
+    for bad_ratio in [0, -1.0]:
+        with pytest.raises(RuntimeError):
+            tr.gen_plant_bitmask(img, bad_ratio)
+
+
+def test_ratio_multiple_files():
+    """Runs the command line with multiple files and tests the results"""
+    result_name = 'result.json'
+    source_image = os.path.join(TESTING_FILE_PATH, 'orthomosaic.tif')
+    assert os.path.exists(source_image)
+
+    # Copy the source image so each output mask gets its own name
+    source_copies = []
+    for idx in range(2):
+        copy_path = os.path.join(TESTING_FILE_PATH, 'multi_source_%d.tif' % idx)
+        shutil.copyfile(source_image, copy_path)
+        source_copies.append(copy_path)
+
+    working_space = os.path.realpath('./test_results')
+    os.makedirs(working_space, exist_ok=True)
+
+    command_line = [SOURCE_PATH, '--working_space', working_space] + source_copies
+    subprocess.run(command_line, check=True)
+
+    # Check that the expected files were created
+    expected_masks = ['multi_source_0_mask.tif', 'multi_source_1_mask.tif']
+    for expected_file in [result_name] + expected_masks:
+        assert os.path.exists(os.path.join(working_space, expected_file))
+
+    # Inspect the created files
+    with open(os.path.join(working_space, result_name), encoding='utf-8') as in_file:
+        res = json.load(in_file)
+        assert 'code' in res
+        assert res['code'] == 0
+        assert 'file' in res
+        created_paths = [one_file['path'] for one_file in res['file']]
+        assert len(created_paths) == 2
+        for expected_file in expected_masks:
+            assert os.path.join(working_space, expected_file) in created_paths
+
+    for expected_file in expected_masks:
+        img = gdal.Open(os.path.join(working_space, expected_file)).ReadAsArray()
+        assert img is not None
+        assert isinstance(img, np.ndarray)
@@ -3,12 +3,20 @@
 """
 
 import argparse
+import concurrent.futures
+import itertools
 import logging
 import os
 import numpy as np
 from osgeo import gdal
 import cv2
 
+try:
+    import numba
+except ImportError:
+    # Numba is optional; the NumPy path is used when it's not installed
+    numba = None
+
 from agpypeline import algorithm, entrypoint, geoimage
 from agpypeline.environment import Environment
 from agpypeline.checkmd import CheckMD
@@ -16,12 +24,53 @@ from agpypeline.checkmd import CheckMD
 from configuration import ConfigurationSoilmaskRatio
 
 
+# Let GDAL spread TIFF compression across cores when writing the masked images
+gdal.SetConfigOption('GDAL_NUM_THREADS', 'ALL_CPUS')
+
 # Define the default green-red ratio value
 GREEN_RED_RATIO = 1.0
 
 # Maximum value a pixel can be
 MAX_PIXEL_VAL = 255
 
+# Number of image rows read and masked per block when processing an image
+MASK_BLOCK_ROWS = 512
+
+# Whether OpenCV has a usable CUDA device for off-loading the mask application
+try:
+    CUDA_AVAILABLE = cv2.cuda.getCudaEnabledDeviceCount() > 0
+except (cv2.error, AttributeError):
+    CUDA_AVAILABLE = False
+
+# Per-process cache of working buffers reused across images (see get_reuse_buffer)
+BUFFER_CACHE = {}
+
+if numba is not None:
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _plant_mask_numba(color_img: np.ndarray, red_limit: np.ndarray, out: np.ndarray) -> int:
+        """Compiled kernel filling in the binary plant mask for an image
+        Arguments:
+            color_img: RGB image to mask
+            red_limit: 256-entry table of the largest red value allowed for each green value
+            out: uint8 array, one entry per pixel, receiving the mask
+        Return:
+            The number of plant pixels found
+        Notes:
+            Uses the same red-limit table as the OpenCV path so both produce
+            identical masks
+        """
+        plant_count = 0
+        for row in numba.prange(color_img.shape[0]):  # pylint: disable=not-an-iterable
+            row_count = 0
+            for col in range(color_img.shape[1]):
+                # Branchless select so the loop compiles to packed SIMD compares
+                is_plant = np.uint8(red_limit[color_img[row, col, 1]] >= color_img[row, col, 0])
+                out[row, col] = np.uint8(MAX_PIXEL_VAL) * is_plant
+                row_count += is_plant
+            plant_count += row_count
+
+        return plant_count
+
 class __internal__:
     """Class for functions intended for internal use only for this file
     """
@@ -66,49 +115,181 @@ class __internal__:
         return extra_metadata
 
     @staticmethod
-    def gen_plant_mask(color_img: np.ndarray, ratio: float) -> np.ndarray:
+    def get_reuse_buffer(name: str, shape: tuple) -> np.ndarray:
+        """Returns a uint8 working buffer that's reused across calls
+        Arguments:
+            name: the name identifying the buffer
+            shape: the required shape of the buffer
+        Return:
+            The buffer to use. Contents are undefined; the buffer is reallocated when
+            the requested shape changes
+        Notes:
+            Buffers are cached per process so batches of same-sized images don't pay
+            an allocation per image. Callers must be done with a buffer before
+            requesting it again
+        """
+        buffer = BUFFER_CACHE.get(name)
+        if buffer is None or buffer.shape != shape:
+            buffer = np.empty(shape, dtype=np.uint8)
+            BUFFER_CACHE[name] = buffer
+
+        return buffer
+
+    @staticmethod
+    def gen_plant_mask(color_img: np.ndarray, ratio: float) -> tuple:
         """Generates an image with plants masked in.
         Arguments:
             color_img: RGB image to mask
             ratio: the red to green ratio
         Return:
-            An RGB image with plants masked in
+            A tuple containing the binary mask and the number of plant pixels found
+        Notes:
+            The compiled kernel accumulates the count while it generates the mask; the
+            OpenCV path counts the finished mask with cv2.countNonZero
         """
-        # Generate the green to red ratio comparison value to make it easy to filter
-        # For a given value of green, red can't be larger than this value else the ratio is exceeded (too much red)
-        max_red_vals = []
-        for idx in range(0, MAX_PIXEL_VAL + 1):
-            max_red_vals.append(min(idx / ratio, MAX_PIXEL_VAL))
-        red_limit = np.array(max_red_vals)
-
-        # Isolate each channel
-        r_channel = color_img[:, :, 2]
+        # For a given value of green, red can't be larger than this value else the ratio
+        # is exceeded (too much red). Truncating to uint8 preserves the floating point
+        # comparison since red values are whole numbers. Both paths below share this
+        # table so they produce identical masks
+        red_limit = np.minimum(np.arange(MAX_PIXEL_VAL + 1, dtype=np.float64) / ratio, MAX_PIXEL_VAL).astype(np.uint8)
+
+        # Prefer the compiled kernel; it streams the image once with no temporaries
+        if numba is not None:
+            mask = __internal__.get_reuse_buffer('plant_mask', color_img.shape[:2])
+            plant_count = int(_plant_mask_numba(color_img, red_limit, mask))
+            return mask, plant_count
+
+        # Isolate the channels we compare
+        r_channel = color_img[:, :, 0]
         g_channel = color_img[:, :, 1]
-        b_channel = color_img[:, :, 0]
-
-        # Calculate what meets the ratio
-        sub_img = red_limit[g_channel.astype('int')] >= r_channel
 
-        mask = np.zeros_like(b_channel)
-        mask[sub_img] = MAX_PIXEL_VAL
+        # The lookup and compare run through OpenCV's SIMD kernels and every intermediate
+        # stays one byte per pixel
+        mask = cv2.compare(cv2.LUT(g_channel, red_limit), r_channel, cv2.CMP_GE)
 
-        return mask
+        return mask, cv2.countNonZero(mask)
 
     @staticmethod
-    def gen_rgb_mask(img: np.ndarray, bin_mask: np.ndarray) -> np.ndarray:
-        """Applies the mask to the image
+    def cuda_apply_mask(img: np.ndarray, bin_mask: np.ndarray) -> np.ndarray:
+        """Applies the binary mask to the RGB bands on a CUDA device
         Arguments:
             img: the source image to mask
             bin_mask: the mask to apply to the image
         Return:
-            A new image that had the mask applied
+            The masked RGB bands, or None when the device path fails
         """
-        rgb_mask = cv2.bitwise_and(img[:, :, 0:3], img[:, :, 0:3], mask=bin_mask)
+        try:
+            gpu_img = cv2.cuda_GpuMat()
+            gpu_img.upload(np.ascontiguousarray(img[:, :, 0:3]))
+            gpu_mask = cv2.cuda_GpuMat()
+            gpu_mask.upload(bin_mask)
+
+            # cuda.bitwise_and doesn't accept a mask with multi-channel images, so mask
+            # each channel separately and merge the results
+            channels = cv2.cuda.split(gpu_img)
+            masked = [cv2.cuda.bitwise_and(one_channel, one_channel, mask=gpu_mask) for one_channel in channels]
 
+            return cv2.cuda.merge(masked).download()
+        except cv2.error as ex:
+            logging.debug("CUDA mask application failed, falling back to CPU: %s", str(ex))
+            return None
+
+    @staticmethod
+    def mask_and_apply(img: np.ndarray, ratio: float, out: np.ndarray = None) -> tuple:
+        """Generates the plant mask and applies it to the image
+        Arguments:
+            img: the source image to mask
+            ratio: the red to green ratio
+            out: optional pre-allocated array receiving the masked image
+        Return:
+            A tuple containing the number of plant pixels, and the masked image
+        Notes:
+            The plant pixel count and the masked image are both derived from a single
+            boolean mask so the image is only traversed once per output
+        """
+        bin_mask, plant_count = __internal__.gen_plant_mask(img, ratio)
+
+        if out is None:
+            out = np.empty_like(img)
+
+        # Degenerate masks skip the masked copy: canopy-closed areas pass straight
+        # through and soil-only areas just zero the color bands
+        if plant_count == bin_mask.size:
+            np.copyto(out, img)
+            return plant_count, out
+        if plant_count == 0:
+            out[:, :, 0:3] = 0
+            if img.shape[2] > 3:
+                out[:, :, 3:] = img[:, :, 3:]
+            return 0, out
+
+        masked_rgb = __internal__.cuda_apply_mask(img, bin_mask) if CUDA_AVAILABLE else None
+        if masked_rgb is not None:
+            out[:, :, 0:3] = masked_rgb
+        else:
+            bool_mask = bin_mask != 0
+            np.multiply(img[:, :, 0:3], bool_mask[:, :, None], out=out[:, :, 0:3])
         if img.shape[2] > 3:
-            rgb_mask = np.concatenate((rgb_mask, img[:, :, 3:]), axis=2)
+            out[:, :, 3:] = img[:, :, 3:]
 
-        return rgb_mask
+        return plant_count, out
+
+    @staticmethod
+    def process_one_file(one_file: str, rgb_mask_tif: str, ratio: float, image_md: dict) -> float:
+        """Masks a single file and writes the result
+        Arguments:
+            one_file: the file to mask
+            rgb_mask_tif: the path to save the masked file to
+            ratio: the lower bound of green-to-red ratio that's considered plant
+            image_md: metadata to save with the masked image
+        Return:
+            The ratio of plant-to-total pixels, or None if the file couldn't be processed
+        """
+        # Get the image's EPSG code
+        epsg = geoimage.get_epsg(one_file)
+        if epsg is not None:
+            # Get the bounds of the image to see if we can process it.
+            bounds = geoimage.image_get_geobounds(one_file)
+
+            if bounds is None:
+                logging.warning("Unable to get bounds of georeferenced image: '%s'",
+                                os.path.basename(one_file))
+                return None
+
+        # Create the mask file
+        logging.debug("Creating mask file '%s'", rgb_mask_tif)
+        mask_ratio, mask_rgb = soilmask_by_ratio(one_file, ratio)
+        if mask_rgb is None:
+            logging.warning("Skipping over image that failed quality check: %s", one_file)
+            return None
+
+        if epsg:
+            geoimage.create_geotiff(mask_rgb, bounds, rgb_mask_tif, epsg, None, False, image_md, compress=True)
+        else:
+            geoimage.create_tiff(mask_rgb, rgb_mask_tif, None, False, image_md, compress=True)
+
+        return mask_ratio
+
+
+def gen_plant_bitmask(color_img: np.ndarray, ratio: float = GREEN_RED_RATIO) -> np.ndarray:
+    """Generates the plant mask as a bit-packed bitmap
+    Arguments:
+        color_img: RGB image to mask
+        ratio: the ratio (as a fraction) serving as the lower bound for determining plant vs. soil
+    Return:
+        The plant mask packed to one bit per pixel along each row (most significant bit first)
+    Notes:
+        Intended for callers that only need the mask; the packed form is 1/8th the size of
+        the byte mask. Recover the byte mask with np.unpackbits(bitmask, axis=1, count=width)
+    """
+    # Check the ratio value for sanity
+    if ratio <= 0:
+        raise RuntimeError("Ratio value for soil masking is zero or a negative number: %s" % str(ratio))
+
+    bin_mask, _ = __internal__.gen_plant_mask(color_img, ratio)
+
+    # packbits sets a bit for any non-zero element, so the 0/255 mask packs directly
+    return np.packbits(bin_mask, axis=1)
 
 
 def soilmask_by_ratio(filename: str, ratio: float = GREEN_RED_RATIO) -> tuple:
@@ -121,24 +302,39 @@ def soilmask_by_ratio(filename: str, ratio: float = GREEN_RED_RATIO) -> tuple:
     Notes:
         Any ratio that equals or exceeds the passed in value is considered a plant pixel and is not masked
         No checks are made to the image for saturation or under exposure
+        The returned array is a per-process buffer that the next call reuses for a
+        same-sized image; copy it if it must outlive that call
     """
     # Check the ratio value for sanity
     if ratio <= 0:
         raise RuntimeError("Ratio value for soil masking is zero or a negative number: %s" % str(ratio))
 
-    # Load the image
-    img = np.rollaxis(gdal.Open(filename).ReadAsArray().astype(np.uint8), 0, 3)
-    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB if img.shape[2] < 4 else cv2.COLOR_BGRA2RGBA)
-
-    # Generate mask
-    bin_mask = __internal__.gen_plant_mask(img, ratio)
-
-    count = np.count_nonzero(bin_mask)
-    ratio = count / float(bin_mask.size)
-
-    rgb_mask = __internal__.gen_rgb_mask(img, bin_mask)
-
-    return ratio, rgb_mask
+    # Open the image. The bands are kept in GDAL band order (R, G, B[, A]) throughout;
+    # the mask only reads the red and green bands and the output is written back in the
+    # same order, so no channel reordering passes are needed
+    dataset = gdal.Open(filename)
+    cols = dataset.RasterXSize
+    rows = dataset.RasterYSize
+    channels = dataset.RasterCount
+
+    # Generate the mask and apply it one block of rows at a time so the working set
+    # stays small regardless of the image size. The output buffer is reused across
+    # same-sized images. A CUDA device gets the whole image as a single block so it's
+    # uploaded and downloaded only once instead of paying a transfer per block
+    masked_img = __internal__.get_reuse_buffer('masked_img', (rows, cols, channels))
+    plant_count = 0
+    block_step = rows if CUDA_AVAILABLE else MASK_BLOCK_ROWS
+    for row_start in range(0, rows, block_step):
+        block_rows = min(block_step, rows - row_start)
+        raw = dataset.ReadAsArray(0, row_start, cols, block_rows)
+        if raw.dtype != np.uint8:
+            raw = raw.astype(np.uint8)
+        # A transpose view puts the bands last without copying the block
+        block_count, _ = __internal__.mask_and_apply(raw.transpose(1, 2, 0), ratio,
+                                                     out=masked_img[row_start:row_start + block_rows])
+        plant_count += block_count
+
+    return plant_count / float(rows * cols), masked_img
 
 
 class SoilmaskByRatio(algorithm.Algorithm):
@@ -178,8 +374,7 @@ class SoilmaskByRatio(algorithm.Algorithm):
             files = check_md.get_list_files()
             try:
                 for one_file in files:
-                    ext = os.path.splitext(one_file)[1].lower()
-                    if ext in self.supported_file_ext:
+                    if one_file.lower().endswith(self.supported_file_ext):
                         result['code'] = 0
                         break
             except Exception as ex:
@@ -210,26 +405,20 @@ class SoilmaskByRatio(algorithm.Algorithm):
 
         # Loop through the files
         try:
+            # The transformer details only depend on the transformer, not the file
+            transformer_info = environment.generate_transformer_md()
+            image_md = __internal__.prepare_metadata_for_geotiff(transformer_info)
+
+            # Build the list of source and destination file pairs to process
+            tasks = []
             for one_file in check_md.get_list_files():
                 # Check file by type
-                ext = os.path.splitext(one_file)[1].lower()
-                if ext not in self.supported_file_ext:
+                if not one_file.lower().endswith(self.supported_file_ext):
                     continue
                 if not os.path.exists(one_file):
                     logging.warning("Unable to access file '%s'", one_file)
                     continue
 
-                # Get the image's EPSG code
-                epsg = geoimage.get_epsg(one_file)
-                if epsg is not None:
-                    # Get the bounds of the image to see if we can process it.
-                    bounds = geoimage.image_get_geobounds(one_file)
-
-                    if bounds is None:
-                        logging.warning("Unable to get bounds of georeferenced image: '%s'",
-                                        os.path.basename(one_file))
-                        continue
-
                 # Get the mask name
                 if environment.args.out_file:
                     rgb_mask_tif = environment.args.out_file
@@ -239,23 +428,26 @@ class SoilmaskByRatio(algorithm.Algorithm):
                     # Use the original name
                     rgb_mask_tif = os.path.join(check_md.working_folder, __internal__.get_maskfilename(one_file))
 
-                # Create the mask file
-                logging.debug("Creating mask file '%s'", rgb_mask_tif)
-                mask_ratio, mask_rgb = soilmask_by_ratio(one_file, environment.args.ratio)
-                if mask_rgb is None:
-                    logging.warning("Skipping over image that failed quality check: %s", one_file)
-                    continue
-
-                # Bands must be reordered to avoid swapping R and B
-                mask_rgb = cv2.cvtColor(mask_rgb, cv2.COLOR_BGR2RGB if mask_rgb.shape[2] < 4 else cv2.COLOR_BGRA2RGBA)
-
-                transformer_info = environment.generate_transformer_md()
+                tasks.append((one_file, rgb_mask_tif))
+
+            # Mask the files across a process pool when there's more than one; the files
+            # are independent of each other. A single destination file means the masks
+            # would overwrite each other, so those run sequentially
+            if len(tasks) > 1 and not environment.args.out_file:
+                num_workers = min(len(tasks), os.cpu_count() or 1)
+                with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+                    mask_ratios = list(executor.map(__internal__.process_one_file,
+                                                    [one_task[0] for one_task in tasks],
+                                                    [one_task[1] for one_task in tasks],
+                                                    itertools.repeat(environment.args.ratio),
+                                                    itertools.repeat(image_md)))
+            else:
+                mask_ratios = [__internal__.process_one_file(one_file, rgb_mask_tif, environment.args.ratio, image_md)
+                               for one_file, rgb_mask_tif in tasks]
 
-                image_md = __internal__.prepare_metadata_for_geotiff(transformer_info)
-                if epsg:
-                    geoimage.create_geotiff(mask_rgb, bounds, rgb_mask_tif, epsg, None, False, image_md, compress=True)
-                else:
-                    geoimage.create_tiff(mask_rgb, rgb_mask_tif, None, False, image_md, compress=True)
+            for (one_file, rgb_mask_tif), mask_ratio in zip(tasks, mask_ratios):
+                if mask_ratio is None:
+                    continue
 
                 transformer_md = {
                     'name': transformer_info['name'],